@@ -6,11 +6,16 @@ import torchvision
 from pathlib import Path
 import numpy as np
 from time import time
+import threading
 import pretty_midi
 import vae
 from vae.midi_dataloader import PianoRoll
 
 
+# MIDI program of the instrument used for the generated and reconstructed midi files
+_PIANO_PROGRAM = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
+
+
 parser = argparse.ArgumentParser(description='VAE MIDI')
 parser.add_argument('--epochs', type=int, default=1, metavar='N',
                     help='number of epochs to train (default: 1)')
@@ -29,24 +34,50 @@ parser.add_argument('--generative', action='store_true', default=False,
 args = parser.parse_args()
 
 
+def to_cpu(obj):
+    # copy every tensor of a (nested) state dict to the host, so that it is not changed by the next optimizer steps
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def stack_losses(losses):
+    # copy the per batch losses collected on the device during an epoch to the host at once
+    return torch.stack(losses).cpu().numpy() if losses else np.zeros(0, dtype=np.float32)
+
+
+def save_checkpoint(state, save_path):
+    # runs in the background save thread, so failures are printed here instead of only reaching the thread excepthook
+    try:
+        torch.save(state, save_path)
+    except Exception as e:
+        print('Could not save model at {}: {}'.format(save_path, e))
+    else:
+        print('Saved model at {}'.format(save_path))
+
+
 def train(epoch):
     model.train()
     model.reset_cells()
     start_time = time()
-    train_loss = 0
-    all_losses = []
-    for batch_idx, data in enumerate(train_loader):
+    losses = []
+    for batch_idx, data in enumerate(vae.midi_dataloader.CUDAPrefetcher(train_loader, device)):
         if data is None:
             model.reset_cells()
             continue
-        data = data.to(device)
-        optimizer.zero_grad()
-        recon_batch, mu, logvar = model(data)
-        loss = loss_function(recon_batch, data, mu, logvar) # sum within each batch, mean over batches
-        loss.backward()
-        train_loss += loss.item()
-        all_losses.append(loss.item())
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+            recon_batch, mu, logvar = compiled_model(data)
+        # binary cross entropy is unsafe to autocast, so the loss is computed in FP32
+        loss = loss_function(recon_batch.float(), data, mu.float(), logvar.float()) # sum within each batch, mean over batches
+        scaler.scale(loss).backward()
+        losses.append(loss.detach()) # no host sync per batch
+        scaler.step(optimizer)
+        scaler.update()
 
         if args.log_interval != 0 and batch_idx % args.log_interval == 0:
             print('Train epoch: {}\tLoss: {:.6f}\tElapsed time: {:.3f} min'.format(
@@ -60,67 +91,73 @@ def train(epoch):
     #TODO: print average train time per epoch?
     #print('====> Epoch: {} Average train loss: {:.4f}\tTotal train time: {:.3f} min'.format(epoch, train_loss / len(train_loader),(time()-start_time)/60.0))
 
+    all_losses = stack_losses(losses)
+    train_loss = float(all_losses.sum())
+
     # save loss numpy array so that it can be plotted/processed later
     np.save(f'../results/losses/train_loss_epoch_{epoch}', all_losses)
 
     #TODO: Decide what to save
     save_path = f'../model_states/model_epoch_{epoch}.tar'
-    torch.save({
+    # snapshot the state on the host here, then write it to disk in the background so that the next epoch can start
+    state = to_cpu({
             'epoch': epoch,
             'model_state_dict': model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
             'loss': train_loss
-            }, save_path)
-    print('Saved model at {}'.format(save_path))
+            })
+    global save_thread
+    if save_thread is not None:
+        save_thread.join() # at most one checkpoint is written at a time
+    save_thread = threading.Thread(target=save_checkpoint, args=(state, save_path))
+    save_thread.start()
 
 
 def validate(epoch):
     model.eval()
     model.reset_cells()
-    valid_loss = 0
-    all_losses = []
+    losses = []
     with torch.no_grad():
-        for batch_idx, data in enumerate(validation_loader):
+        for batch_idx, data in enumerate(vae.midi_dataloader.CUDAPrefetcher(validation_loader, device)):
             if data is None:
                 continue
-            data = data.to(device)
-            recon_batch, mu, logvar = model(data)
-            loss = loss_function(recon_batch, data, mu, logvar)
-            valid_loss += loss.item()
-            all_losses.append(loss.item())
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                recon_batch, mu, logvar = compiled_model(data)
+            loss = loss_function(recon_batch.float(), data, mu.float(), logvar.float())
+            losses.append(loss.detach())
     
-    #TODO: make this print statement work - len(validation_loader) is none
-    #print('====> Epoch: {} Average validation loss: {:.4f}'.format(epoch, valid_loss / len(validation_loader)))
+    all_losses = stack_losses(losses)
+    if len(all_losses) > 0:
+        print('====> Epoch: {} Average validation loss: {:.4f}'.format(epoch, all_losses.mean()))
     np.save(f'../results/losses/validation_loss_epoch_{epoch}', all_losses)
 
 
 def test(epoch):
     model.eval()
     model.reset_cells()
-    test_loss = 0
-    all_losses = []
+    losses = []
     with torch.no_grad():
-        for batch_idx, data in enumerate(test_loader):
+        for batch_idx, data in enumerate(vae.midi_dataloader.CUDAPrefetcher(test_loader, device)):
             if data is None:
                 continue
 
-            data = data.to(device)
-            recon_batch, mu, logvar = model(data)
-            loss = loss_function(recon_batch, data, mu, logvar)
-            test_loss += loss.item()
-            all_losses.append(loss.item())
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                recon_batch, mu, logvar = compiled_model(data)
+            loss = loss_function(recon_batch.float(), data, mu.float(), logvar.float())
+            losses.append(loss.detach())
 
             #TODO: implement multiple (random) samples from the test, i.e. not only when the batch_idx == 50
             if batch_idx == 50:
-                origi = data[0,1:,:].cpu()
-                recon = torch.bernoulli(recon_batch[0,:,:]).cpu()
-                concat = torch.cat([origi, recon], 0)
-                concat = concat * 100
-                concat = torch.t(concat)
+                # original and sampled reconstruction are written straight into one preallocated piano roll
+                length = recon_batch.shape[1]
+                concat = torch.empty(2*length, recon_batch.shape[2], device=device)
+                concat[:length] = data[0,1:,:]
+                torch.bernoulli(recon_batch[0,:,:].float(), out=concat[length:])
+                concat = concat.mul_(100).t().cpu()
 
                 # convert piano roll to midi
-                program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
-                midi_from_proll = vae.midi_utils.piano_roll_to_pretty_midi(concat, fs = 16, program = program)
+                midi_from_proll = vae.midi_utils.piano_roll_to_pretty_midi(concat, fs = 16, program = _PIANO_PROGRAM)
 
                 # save midi to specified location
                 save_path = f'../results/reconstruction/reconstruction_epoch_{epoch}.midi'
@@ -130,49 +167,31 @@ def test(epoch):
                 # save piano roll image
                 torchvision.utils.save_image(concat, f'../results/reconstruction/reconstruction_epoch_{epoch}.png')
 
-    #print('\n====> Average test loss after {} epochs: {:.4f}'.format(epoch, test_loss / len(test_loader)))
+    all_losses = stack_losses(losses)
+    if len(all_losses) > 0:
+        print('\n====> Average test loss after {} epochs: {:.4f}'.format(epoch, all_losses.mean()))
     np.save(f'../results/losses/test_loss_epoch_{epoch}', all_losses)
 
 
-def generate_beat(model, x0, z0, beat_length=16):
-    zx = torch.cat([x0, z0], 2) # creating the initial zx from the x0 start vector and z
-    samples = [x0]
-    for n in range(beat_length-1):
-        output = model.decode(zx)
-        z  = torch.cat([z0 for _ in range(n+2)], 1) # merging the original z with itself, it needs to have the same sequence size as the next x input
-        x  = torch.bernoulli(output[:, -1, :]) # sample output of last cell from decoder
-        samples.append(torch.unsqueeze(x,0)) # append to samples list for later
-        x  = torch.cat(samples, 1) # concat input for next decoding sequence
-        zx = torch.cat([x, z], 2) # merging the z-s with the inputs (x0 + the last output)
-    return x
-
-
 def sample(name, bars):
     model.eval()
-    model.reset_cells()
     with torch.no_grad():
-        samples = []
-        
-        # initialize the first z latent variable and the very first note (x0) which starts the melody 
-        sample_z = torch.randn(1, 1, model.embedding_size).to(device)
-        sample_x = torch.zeros(1, 1, model.input_size).to(device) #TODO: check if this is good or not
-
-        # generate `bars` many beats
-        for i in range(bars):
-            sample = generate_beat(model, sample_x, sample_z)
-            samples.append(sample.cpu())
-            sample_z = torch.randn(1, 1, model.embedding_size).to(device) # sample new z
-            sample_x = torch.unsqueeze(sample[:, -1, :], 0) # continue next beat from last sound of previous beat
+        # every beat starts from its own random z and a silent first note (x0), so all `bars` beats
+        # are generated in parallel as one batch and then stitched together in order
+        sample_z = torch.randn(bars, 1, model.embedding_size, device=device)
+        sample_x = torch.zeros(bars, 1, model.input_size, device=device) #TODO: check if this is good or not
+        h = torch.zeros(1, bars, model.hidden_size, device=device)
+        c = torch.zeros(1, bars, model.hidden_size, device=device)
+
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+            samples, _, _ = decoder.generate_beat(sample_x, sample_z, h, c)
         
         # generate piano roll from beats    
-        all_samples = torch.cat(samples, 1)
-        all_samples = all_samples * 60
-        all_samples = torch.t(torch.squeeze(all_samples))
+        all_samples = samples.view(-1, model.input_size).mul_(60).t().cpu() # single copy to the host
 
         # convert piano roll to midi
-        program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
         #TODO: check what `fs` we should use here
-        midi_from_proll = vae.midi_utils.piano_roll_to_pretty_midi(all_samples, fs = 16, program = program)
+        midi_from_proll = vae.midi_utils.piano_roll_to_pretty_midi(all_samples, fs = 16, program = _PIANO_PROGRAM)
 
         # save midi to specified location
         save_path = f'../results/sample/sample_epoch_{name}.midi'
@@ -196,9 +215,25 @@ if __name__ == "__main__":
 
     # create model, optimizer, and loss function on specific device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    #kwargs = {'num_workers': 1, 'pin_memory': True} if cuda else {}
+    torch.set_float32_matmul_precision('high')
+    # the training batches always have the same shape (drop_last=True), so the fastest cuDNN LSTM algorithm can be cached
+    torch.backends.cudnn.benchmark = True
+
+    # mixed precision: BF16 on Ampere or newer, FP16 on older GPUs (BF16 is only a placeholder when autocast is disabled)
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.float16 if use_amp and torch.cuda.get_device_capability()[0] < 8 else torch.bfloat16
     model = vae.vae.MIDI(88,64,32,args.sequence_length).to(device)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    # the loss is scaled even with BF16, since autocast still runs the cuDNN LSTMs in FP16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+    # on the GPU, fuse the forward pass and the loss terms with TorchInductor (on the CPU it would need a C++ toolchain);
+    # the uncompiled `model` is kept for saving and loading so that the checkpoint keys do not change (the default mode
+    # is used since the carried LSTM states stored on the model do not go well with the CUDA graphs of `reduce-overhead`)
+    compiled_model = model
+    if device.type == 'cuda':
+        compiled_model = torch.compile(model)
+        vae.vae.compile_bce_kld()
     loss_function = vae.vae.bce_kld_loss
 
     # load the model parameters from the saved file if given (.tar extension)
@@ -207,12 +242,32 @@ if __name__ == "__main__":
         checkpoint = torch.load(args.bootstrap, map_location=device)
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if checkpoint.get('scaler_state_dict'): # missing in older checkpoints, empty if saved without a GPU
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
         c_epoch = checkpoint['epoch']
         loss = checkpoint['loss']
         print('Bootstrapping model from {}'.format(args.bootstrap))
         if not args.generative:
             print('Continuing training from epoch: {}\n'.format(c_epoch+1))
 
+    # when only generating, quantize the weights of the linear and LSTM layers to INT8
+    # (dynamic quantization is only supported on the CPU, so generation runs there)
+    if args.generative:
+        device = torch.device('cpu')
+        use_amp = False
+        model = torch.quantization.quantize_dynamic(model.cpu(), {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+    # compile the decoder and its generation loop, and warm it up with the batch of `bars` beats that `sample` generates
+    # so that the first sample does not pay for the specialization
+    bars = 16
+    decoder = torch.jit.script(vae.vae.MIDIDecoder(model))
+    with torch.no_grad(), torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+        for _ in range(2):
+            decoder.generate_beat(torch.zeros(bars, 1, model.input_size, device=device),
+                                  torch.zeros(bars, 1, model.embedding_size, device=device),
+                                  torch.zeros(1, bars, model.hidden_size, device=device),
+                                  torch.zeros(1, bars, model.hidden_size, device=device))
+
     # if we want to train
     if not args.generative:
         # create dataset and loaders
@@ -243,18 +298,25 @@ if __name__ == "__main__":
         #validation_loader = DataLoader(sinus_dataset, batch_size=args.batch_size, sampler=validation_sampler, drop_last=True)
         ###########
 
+        # the loaders are generators that keep the sequences of a song in order (None marks the end of a song),
+        # so they cannot be split across worker processes, but their batches can be pinned for faster copies
+        kwargs = {'pin_memory': True} if device.type == 'cuda' else {}
+
         # start training and save a sample after each epoch
+        save_thread = None
         for epoch in range(c_epoch+1, (c_epoch + args.epochs + 1)):
-            train_loader      = vae.midi_dataloader.data_loader(train_dataset, train_sampler)
-            validation_loader = vae.midi_dataloader.data_loader(valid_dataset, valid_sampler)
-            test_loader       = vae.midi_dataloader.data_loader(test_dataset,  test_sampler)
+            train_loader      = vae.midi_dataloader.data_loader(train_dataset, train_sampler, **kwargs)
+            validation_loader = vae.midi_dataloader.data_loader(valid_dataset, valid_sampler, **kwargs)
+            test_loader       = vae.midi_dataloader.data_loader(test_dataset,  test_sampler, **kwargs)
       
             train(epoch)
             validate(epoch)
-            sample(name=epoch, bars=16)
+            sample(name=epoch, bars=bars)
+        if save_thread is not None:
+            save_thread.join()
         test((c_epoch + args.epochs))
 
     # otherwise simply generate a sample from the loaded model
     else:
         print('Generating sample from the loaded model...')
-        sample(name='generative', bars=16)
\ No newline at end of file
+        sample(name='generative', bars=bars)
\ No newline at end of file
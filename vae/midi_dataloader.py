@@ -245,23 +245,66 @@ class SINUSDataset(Dataset):
         return np.transpose(sequence)
 
 
-def data_loader(dataset, sampler):
+def data_loader(dataset, sampler, pin_memory=False):
     for indices in sampler:
-        samplers = []
-        for index in indices:
-            samplers.append(SequentialSampler(dataset[index]))
+        rolls = [dataset[index] for index in indices]
+        samplers = [SequentialSampler(roll) for roll in rolls]
             
         #for samples in itertools.zip_longest(*samplers):
         for samples in zip(*samplers):
-            batch = []
-            for i in range(len(samples)):
-                if samples[i] is not None:
-                    batch.append(torch.unsqueeze(torch.from_numpy(dataset[indices[i]][samples[i]]),0))
+            batch = [torch.from_numpy(rolls[i][samples[i]]) for i in range(len(samples)) if samples[i] is not None]
 
-            yield torch.cat(batch, 0)
+            # stack straight into page-locked memory if requested, which allows asynchronous host to device copies
+            out = torch.empty((len(batch),) + batch[0].shape, dtype=batch[0].dtype, pin_memory=pin_memory)
+            yield torch.stack(batch, out=out)
         yield None
 
 
+class CUDAPrefetcher:
+    """
+    Wraps a loader and copies the next batch to `device` on a side CUDA stream while the current batch is being processed.
+    End of song markers (None) are passed through unchanged. On a non CUDA device batches are copied synchronously.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_data = next(self.loader)
+        except StopIteration:
+            self.exhausted = True
+            return
+        self.exhausted = False
+
+        if self.next_data is None:
+            return
+        if self.stream is None:
+            self.next_data = self.next_data.to(self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_data = self.next_data.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.exhausted:
+            raise StopIteration
+
+        data = self.next_data
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            if data is not None:
+                # the batch was allocated on the side stream but is consumed on the current one
+                data.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return data
+
+
 def split_dataset(dataset, test_split=0.15, validation_split=0.15, shuffle=True):
     """
     Splits a given dataset into train, test, and validation sets.
@@ -40,8 +40,9 @@ class MIDI(nn.Module):
         else:
             x, (self.h_en, self.c_en) = self.rnn1(x)
 
-        self.h_en = self.h_en.detach()
-        self.c_en = self.c_en.detach()
+        # keep the carried cell states in FP32 even when the LSTM runs under autocast
+        self.h_en = self.h_en.detach().float()
+        self.c_en = self.c_en.detach().float()
 
         # `x` has shape (batch, sequence, direction, hidden_size)
         # the LSTM implements sequence many cells, so `x` contains the output (hidden state) of each cell
@@ -72,8 +73,8 @@ class MIDI(nn.Module):
         else:
             x, (self.h_de, self.c_de) = self.drnn1(zx)
 
-        self.h_de = self.h_de.detach()
-        self.c_de = self.c_de.detach()
+        self.h_de = self.h_de.detach().float()
+        self.c_de = self.c_de.detach().float()
 
         return self.sigmoid(self.fnn1(x))
 
@@ -81,10 +82,10 @@ class MIDI(nn.Module):
         mu, logvar = self.encode(x[:, 1:, :])
         z = self.reparameterize(mu, logvar)
         z = torch.unsqueeze(z,1) # add a third dimension (middle) to be able to concatenate with x
-        z = torch.cat([z for _ in range(self.sequence_length-1)], 1)
+        z = z.expand(-1, self.sequence_length-1, -1) # broadcasted view, materialized by the concatenation below
         mask = torch.FloatTensor(x.shape[0], x.shape[1]).uniform_() < 0.2
         mask = torch.unsqueeze(mask,2)
-        mask = torch.cat([mask for _ in range(x.shape[-1])], 2)
+        mask = mask.expand(-1, -1, x.shape[-1])
         mask = mask.float().to(x.device)
         x = (1 - mask) * x
         #x = (1 - mask) * x + mask * torch.zeros_like(x)
@@ -99,9 +100,37 @@ class MIDI(nn.Module):
         self.c_de = None
 
 
+class MIDIDecoder(nn.Module):
+    # Single step decoder of a `MIDI` model that can be compiled with `torch.jit.script`.
+    # The LSTM cell states are passed in and returned explicitly instead of being stored on the module,
+    # so a sequence can be generated one step at a time without decoding its whole prefix again.
+    # The layers are shared with the wrapped model, so it always decodes with the current weights.
+    def __init__(self, midi):
+        super(MIDIDecoder, self).__init__()
+
+        self.drnn1 = midi.drnn1
+        self.fnn1 = midi.fnn1
+
+    def forward(self, x_t, z_t, h, c):
+        x, (h, c) = self.drnn1(torch.cat([x_t, z_t], 2), (h, c))
+        return torch.sigmoid(self.fnn1(x)), h, c
+
+    @torch.jit.export
+    def generate_beat(self, x0, z0, h, c, beat_length: int = 16):
+        # decode one step at a time from the carried cell states, feeding back the note sampled at the previous step
+        beat = torch.empty(x0.shape[0], beat_length, x0.shape[2], device=x0.device)
+        beat[:, :1, :] = x0
+        x = x0
+        for n in range(beat_length-1):
+            output, h, c = self.forward(x, z0, h, c)
+            x = torch.bernoulli(output) # sample output of the decoder cell
+            beat[:, n+1:n+2, :] = x
+        return beat, h, c
+
+
 # Reconstruction + KL divergence losses summed over all elements and batch
-beta = 0
-def bce_kld_loss(recon_x, x, mu, logvar):
+# kept free of the annealed `beta` so that it can be compiled without recompiling whenever `beta` changes
+def bce_kld(recon_x, x, mu, logvar):
     BCE = F.binary_cross_entropy(recon_x, x[:, 1:, :], reduction='none')
     BCE = torch.sum(BCE, (1,2)) # sum over 2nd and 3rd dimensions (keeping it separate for each batch)
     BCE = torch.mean(BCE) # average over batch losses
@@ -109,6 +138,20 @@ def bce_kld_loss(recon_x, x, mu, logvar):
     KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp(), 1) # sum over 2nd dimension
     KLD = torch.mean(KLD) # average over batch losses
 
+    return BCE, KLD
+
+
+# loss terms used by `bce_kld_loss`, replaced by a compiled version with `compile_bce_kld`
+_bce_kld = bce_kld
+def compile_bce_kld():
+    global _bce_kld
+    _bce_kld = torch.compile(bce_kld)
+
+
+beta = 0
+def bce_kld_loss(recon_x, x, mu, logvar):
+    BCE, KLD = _bce_kld(recon_x, x, mu, logvar)
+
     global beta
     beta += 0.05
     if beta > 1: